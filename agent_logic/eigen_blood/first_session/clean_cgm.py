@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import sys
 
@@ -12,10 +13,10 @@ print(f"Input file: {INPUT_FILENAME}")
 
 # --- Step 1: Load the data file ---
 try:
-    # We use 'sep='\s\s+'' to handle the variable number of spaces between columns.
-    # 'engine='python'' is required for this type of separator.
+    # The LibreView export is comma-separated, so pandas' fast C parser can read it
+    # directly (a regex separator would force the much slower Python engine).
     # 'skiprows=1' ignores the first metadata line ("Glucose Data...").
-    cgm_df = pd.read_csv(INPUT_FILENAME, sep='\s\s+', engine='python', skiprows=1)
+    cgm_df = pd.read_csv(INPUT_FILENAME, sep=',', engine='c', skiprows=1)
     print("✓ File loaded successfully.")
 
 except FileNotFoundError:
@@ -35,14 +36,17 @@ cgm_df.columns = cgm_df.columns.str.strip()
 # We'll call it 'glucose_mmol_L'.
 # The logic: Use the value from 'Scan Glucose mmol/L' if it exists.
 # If it's empty (NaN), then use the value from 'Historic Glucose mmol/L'.
-cgm_df['glucose_mmol_L'] = cgm_df['Scan Glucose mmol/L'].fillna(cgm_df['Historic Glucose mmol/L'])
+scan = cgm_df['Scan Glucose mmol/L']
+cgm_df['glucose_mmol_L'] = np.where(scan.notna(), scan, cgm_df['Historic Glucose mmol/L'])
 print("✓ Glucose columns consolidated.")
 
 # --- Step 3: Format the timestamp ---
 
 # Convert the 'Device Timestamp' column from a string to a proper datetime object.
-# 'dayfirst=True' is CRITICAL because your format is DD-MM-YYYY.
-cgm_df['timestamp'] = pd.to_datetime(cgm_df['Device Timestamp'], dayfirst=True)
+# The explicit DD-MM-YYYY format is CRITICAL (day comes first), and it also lets
+# pandas use its fast fixed-format parser instead of guessing per row.
+# Unparseable timestamps become NaT and are dropped in Step 4.
+cgm_df['timestamp'] = pd.to_datetime(cgm_df['Device Timestamp'], format='%d-%m-%Y %H:%M', errors='coerce')
 print("✓ Timestamps converted to datetime objects.")
 
 # --- Step 4: Create the final, clean DataFrame ---
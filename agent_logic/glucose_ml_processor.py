@@ -52,6 +52,13 @@ USABLE_CHANNELS = [
     (7,3,'long'),(7,9,'long'),(7,12,'long'),(8,2,'long'),(8,3,'long'),(8,11,'long'),(8,13,'long'),
 ]
 
+# Raw optical intensity columns needed for the usable channels
+FNIRS_SIGNAL_COLUMNS = [
+    f'S{s}_D{d}_{wl}_{"LP" if ctype == "short" else "RP"}'
+    for s, d, ctype in USABLE_CHANNELS
+    for wl in ('740nm', '850nm')
+]
+
 # fNIRS optical constants
 DPF_WL1 = 6.25
 DPF_WL2 = 4.89
@@ -190,6 +197,24 @@ class BlockedKFold:
             yield np.concatenate([train_before, train_after]), test
 
 
+def read_fnirs_csv(path: str, columns: List[str]) -> pd.DataFrame:
+    """
+    Load only the requested fNIRS columns (plus 'Time') with stripped names
+    
+    Optical intensities are float32 at the device, so parsing them as float32
+    halves memory without losing precision; 'Time' stays float64 for the
+    sampling-rate and interpolation maths.
+    """
+    wanted = set(columns) | {'Time'}
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [c for c in header if c.strip() in wanted]
+    dtype = {c: np.float32 for c in usecols if c.strip() != 'Time'}
+    
+    df = pd.read_csv(path, usecols=usecols, dtype=dtype, engine='c')
+    df.columns = df.columns.str.strip()
+    return df
+
+
 def preprocess_and_feature_engineer(fnirs_path: str, cgm_path: str, 
                                   cgm_column: str) -> ProcessingResult:
     """
@@ -216,9 +241,8 @@ def preprocess_and_feature_engineer(fnirs_path: str, cgm_path: str,
         actual_fnirs_path = fnirs_path
         actual_cgm_path = cgm_path
     
-    # Load data
-    df_fnirs = pd.read_csv(actual_fnirs_path)
-    df_fnirs.columns = df_fnirs.columns.str.strip()
+    # Load data (only the channels used below)
+    df_fnirs = read_fnirs_csv(actual_fnirs_path, FNIRS_SIGNAL_COLUMNS)
     
     df_cgm = pd.read_csv(actual_cgm_path)
     df_cgm.columns = df_cgm.columns.str.strip()
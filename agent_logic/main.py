@@ -1,5 +1,6 @@
 
 import os
+import sys
 import base58
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -56,6 +57,14 @@ async def startup_event():
     else:
         print("WARNING: NEAR_ACCOUNT_ID or NEAR_SEED_PHRASE not found. On-chain transactions are disabled.")
 
+# --- Shutdown Event to Release Pooled Connections ---
+@app.on_event("shutdown")
+async def shutdown_event():
+    # sleep_vision is imported lazily by the route, so only close it if it was loaded
+    sleep_vision = sys.modules.get("sleep_vision")
+    if sleep_vision is not None:
+        await sleep_vision.sleep_analyzer.aclose()
+
 # --- API Endpoints ---
 
 @app.options("/verify-rest")
@@ -74,10 +83,10 @@ async def verify_rest(request: ProofOfRestRequest):
 
     # Step 1: Computer vision analysis using PaliGemma
     try:
-        from sleep_vision import verify_sleep_photo
+        from sleep_vision import verify_sleep_photo_async
         
         print(f"Analyzing sleep photo for user: {request.accountId}")
-        vision_result = verify_sleep_photo(request.photoDataUri)
+        vision_result = await verify_sleep_photo_async(request.photoDataUri)
         
         is_verified = vision_result['is_valid_sleep_surface']
         confidence = vision_result['confidence']
@@ -12,6 +12,7 @@ from fastapi import FastAPI, HTTPException
 import numpy as np
 import pandas as pd
 from dataclasses import dataclass
+from functools import lru_cache
 import os
 import tempfile
 import io
@@ -387,6 +388,22 @@ ml_app = FastAPI(
 # Initialize ML pipeline
 pipeline = MLPipeline()
 
+# Small chunks keep the per-request Shapley calculation fast
+SHAPLEY_CHUNK_MINUTES = 2.0
+
+
+@lru_cache(maxsize=1)
+def _load_reference_chunks():
+    """
+    Load and chunk the reference fNIRS sessions once per process
+    
+    Every scoring request compares the user's data against the same two
+    sessions, so the large CSV reads and chunking are shared across requests.
+    A failed load is not cached and will be retried on the next request.
+    """
+    from shapley_scorer import ShapleyScorer
+    return ShapleyScorer(chunk_size_minutes=SHAPLEY_CHUNK_MINUTES).load_and_chunk_data()
+
 
 @ml_app.post("/api/score-contribution", response_model=ScoreContributionResponse)
 async def score_contribution(request: ScoreContributionRequest) -> ScoreContributionResponse:
@@ -432,7 +449,7 @@ async def score_contribution(request: ScoreContributionRequest) -> ScoreContribu
             from shapley_scorer import ShapleyScorer, DataChunk
             
             # Initialize Shapley scorer with fast settings for API response
-            shapley_scorer = ShapleyScorer(chunk_size_minutes=2.0)  # Small chunks for fast calculation
+            shapley_scorer = ShapleyScorer(chunk_size_minutes=SHAPLEY_CHUNK_MINUTES)
             
             # Convert user data to format expected by Shapley scorer
             user_fnirs_array = pipeline._parse_fnirs_csv_to_array(request.fnirs_data)
@@ -448,8 +465,8 @@ async def score_contribution(request: ScoreContributionRequest) -> ScoreContribu
                 session_id="user_contribution"
             )
             
-            # Load existing session data for comparison
-            session1_chunks, session2_chunks = shapley_scorer.load_and_chunk_data()
+            # Existing session data for comparison (loaded once per process)
+            session1_chunks, session2_chunks = _load_reference_chunks()
             
             print(f"Loaded {len(session1_chunks)} chunks from Session 1, {len(session2_chunks)} chunks from Session 2")
             
@@ -13,17 +13,29 @@ Two modes:
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import r2_score, mean_absolute_error
+from sklearn.metrics import mean_absolute_error
 from sklearn.preprocessing import StandardScaler
 import random
+from itertools import combinations
+from math import comb
 from typing import List, Dict, Tuple, Optional
 import time
 from dataclasses import dataclass
 
 # Import existing ML components
-from glucose_ml_processor import GlucoseMLProcessor, preprocess_and_feature_engineer
+from glucose_ml_processor import GlucoseMLProcessor, preprocess_and_feature_engineer, read_fnirs_csv
 from data_file_manager import DataFileManager
 
+def _fast_r2(y_true: np.ndarray, y_pred: np.ndarray) -> float:
+    """R² computed directly in NumPy (skips sklearn's input validation in the hot loop)"""
+    y_true = np.asarray(y_true, dtype=np.float32)
+    y_pred = np.asarray(y_pred, dtype=np.float32)
+    ss_res = float(((y_true - y_pred) ** 2).sum())
+    ss_tot = float(((y_true - y_true.mean()) ** 2).sum())
+    if ss_tot == 0.0:
+        return -1.0
+    return 1.0 - ss_res / ss_tot
+
 @dataclass
 class DataChunk:
     """Represents a chunk of fNIRS + glucose data (simulates user contribution)"""
@@ -55,6 +67,8 @@ class ShapleyScorer:
     def __init__(self, chunk_size_minutes: float = 5.0):
         self.chunk_size_minutes = chunk_size_minutes
         self.chunk_size_samples = int(chunk_size_minutes * 60 * 10)  # 10 Hz sampling
+        self._chunk_xy_cache: Dict[DataChunk, Optional[Tuple[np.ndarray, np.ndarray]]] = {}
+        self._test_xy_cache: Dict[frozenset, Optional[Tuple[np.ndarray, np.ndarray]]] = {}
         self.ml_processor = GlucoseMLProcessor()
         self.data_manager = DataFileManager('eigen_blood')
         
@@ -95,7 +109,7 @@ class ShapleyScorer:
             data = None
             for path in possible_paths:
                 try:
-                    data = pd.read_csv(path)
+                    data = read_fnirs_csv(path, ['S1_D1_740nm_LP', 'S1_D1_850nm_LP'])
                     print(f"Successfully loaded data from: {path}")
                     break
                 except FileNotFoundError:
@@ -163,39 +177,24 @@ class ShapleyScorer:
         """
         print(f"Calculating within-session Shapley for chunk {target_chunk_id}...")
         
-        target_chunk = session_chunks[target_chunk_id]
-        other_chunks = [c for c in session_chunks if c.chunk_id != target_chunk_id]
+        # target_chunk_id is the target's position in session_chunks
+        other_ids = [i for i in range(len(session_chunks)) if i != target_chunk_id]
         
-        if len(other_chunks) < 2:
+        if len(other_ids) < 2:
             return 0.0  # Need at least 2 other chunks
         
-        shapley_value = 0.0
-        
-        for i in range(num_coalitions):
-            # Sample random coalition size (1 to len(other_chunks)-1)
-            coalition_size = random.randint(1, max(1, len(other_chunks) - 1))
-            
-            # Sample random coalition of other chunks
-            coalition = random.sample(other_chunks, coalition_size)
-            
+        # Coalition sizes 1 to len(other_ids)-1 (one chunk is kept for testing)
+        samples = []
+        for coalition_ids in self._stratified_coalitions(other_ids, len(other_ids) - 1, num_coalitions):
             # Reserve one chunk for testing (not in coalition or target)
-            remaining_chunks = [c for c in other_chunks if c not in coalition]
-            if not remaining_chunks:
-                continue
-            test_chunk = random.choice(remaining_chunks)
-            
-            # Performance WITHOUT target chunk
-            perf_without = self._train_and_evaluate(coalition, [test_chunk])
-            
-            # Performance WITH target chunk
-            coalition_with_target = coalition + [target_chunk]
-            perf_with = self._train_and_evaluate(coalition_with_target, [test_chunk])
+            remaining_ids = [c for c in other_ids if c not in coalition_ids]
+            test_id = random.choice(remaining_ids)
             
-            # Marginal contribution
-            marginal_contribution = perf_with - perf_without
-            shapley_value += marginal_contribution
+            samples.append((coalition_ids, [test_id]))
         
-        return shapley_value / num_coalitions
+        contributions = self._evaluate_coalitions(session_chunks, target_chunk_id, samples)
+        
+        return self._stratified_mean(samples, contributions)
     
     def calculate_between_session_shapley(self, session1_chunks: List[DataChunk],
                                         session2_chunks: List[DataChunk],
@@ -209,99 +208,132 @@ class ShapleyScorer:
         """
         print(f"Calculating between-session Shapley for chunk {target_chunk_id}...")
         
-        target_chunk = session1_chunks[target_chunk_id]
-        other_chunks = [c for c in session1_chunks if c.chunk_id != target_chunk_id]
+        # target_chunk_id is the target's position in session1_chunks
+        other_ids = [i for i in range(len(session1_chunks)) if i != target_chunk_id]
         
-        if len(other_chunks) < 1:
+        if len(other_ids) < 1:
             return 0.0
         
         # Use all of Session 2 as test set
-        test_chunks = session2_chunks
+        all_chunks = session1_chunks + session2_chunks
+        test_ids = list(range(len(session1_chunks), len(all_chunks)))
         
-        shapley_value = 0.0
+        # Coalitions from other Session 1 chunks, sizes 1 to len(other_ids)
+        samples = [
+            (coalition_ids, test_ids)
+            for coalition_ids in self._stratified_coalitions(other_ids, len(other_ids), num_coalitions)
+        ]
         
-        for i in range(num_coalitions):
-            # Sample random coalition from other Session 1 chunks
-            coalition_size = random.randint(1, len(other_chunks))
-            coalition = random.sample(other_chunks, coalition_size)
-            
-            # Performance WITHOUT target chunk
-            perf_without = self._train_and_evaluate(coalition, test_chunks)
-            
-            # Performance WITH target chunk
-            coalition_with_target = coalition + [target_chunk]
-            perf_with = self._train_and_evaluate(coalition_with_target, test_chunks)
-            
-            # Marginal contribution
-            marginal_contribution = perf_with - perf_without
-            shapley_value += marginal_contribution
+        contributions = self._evaluate_coalitions(all_chunks, target_chunk_id, samples)
         
-        return shapley_value / num_coalitions
+        return self._stratified_mean(samples, contributions)
     
-    def _train_and_evaluate(self, train_chunks: List[DataChunk], 
-                          test_chunks: List[DataChunk]) -> float:
-        """Train model on training chunks, evaluate on test chunks"""
+    def _evaluate_coalitions(self, chunks: List[DataChunk], target_id: int,
+                             samples: List[Tuple[List[int], List[int]]]) -> List[float]:
+        """Evaluate sampled coalitions (coalitions and test sets are indices into ``chunks``)"""
+        return [
+            self._marginal_contribution(chunks, coalition_ids, test_ids, target_id)
+            for coalition_ids, test_ids in samples
+        ]
+    
+    def _marginal_contribution(self, chunks: List[DataChunk], coalition_ids: List[int],
+                               test_ids: List[int], target_id: int) -> float:
+        """Performance gain from adding the target chunk to a coalition"""
+        coalition_xy = self._stack_chunks([chunks[i] for i in coalition_ids])
+        test_xy = self._test_stack([chunks[i] for i in test_ids])
+        
+        # Performance WITHOUT target chunk
+        perf_without = self._fit_and_score(coalition_xy, test_xy)
+        
+        # Performance WITH target chunk (reuses the coalition stack)
+        coalition_with_target = self._append_chunk(coalition_xy, chunks[target_id])
+        perf_with = self._fit_and_score(coalition_with_target, test_xy)
+        
+        return perf_with - perf_without
+    
+    def _stratified_coalitions(self, other_ids: List[int], max_size: int,
+                               num_coalitions: int) -> List[List[int]]:
+        """
+        Coalitions stratified by size 1..max_size
+        
+        Every size gets one draw first; leftover budget is dealt out
+        round-robin in extremes-first order (1, max_size, 2, max_size-1, ...),
+        where marginal contributions vary most. If the budget is smaller than
+        the number of sizes, a uniformly random subset of sizes is drawn
+        instead, so no size is systematically left out. A size never gets
+        more draws than it has distinct coalitions; a stratum whose draws
+        reach that count is enumerated exactly, and the others are sampled
+        without repeats.
+        """
+        max_size = max(1, max_size)
+        order = []
+        low, high = 1, max_size
+        while low <= high:
+            order.append(low)
+            if high != low:
+                order.append(high)
+            low, high = low + 1, high - 1
+        
+        counts = dict.fromkeys(order, 0)
+        if num_coalitions < len(order):
+            # Too few draws for every size: one draw each for a random subset
+            for size in random.sample(order, num_coalitions):
+                counts[size] = 1
+        else:
+            budget = num_coalitions
+            while budget > 0:
+                allocated = False
+                for size in order:
+                    if budget > 0 and counts[size] < comb(len(other_ids), size):
+                        counts[size] += 1
+                        budget -= 1
+                        allocated = True
+                if not allocated:
+                    break  # Every coalition is already enumerated
+        
+        coalitions = []
+        for size in order:
+            if counts[size] == comb(len(other_ids), size):
+                coalitions.extend(list(c) for c in combinations(other_ids, size))
+                continue
+            seen = set()
+            while len(seen) < counts[size]:
+                coalition = tuple(sorted(random.sample(other_ids, size)))
+                if coalition not in seen:
+                    seen.add(coalition)
+                    coalitions.append(list(coalition))
+        
+        return coalitions
+    
+    def _stratified_mean(self, samples: List[Tuple[List[int], List[int]]],
+                         contributions: List[float]) -> float:
+        """
+        Shapley estimate from stratified samples
+        
+        Averages marginal contributions within each coalition size, then
+        weights every sampled size equally. The Shapley value weights all
+        sizes equally; sizes 1..max_size are covered when the budget allows,
+        otherwise the sampled sizes are a uniformly random subset, so the
+        estimate stays unbiased over those sizes (the empty coalition cannot
+        be fitted and is never sampled).
+        """
+        strata: Dict[int, List[float]] = {}
+        for (coalition_ids, _), contribution in zip(samples, contributions):
+            strata.setdefault(len(coalition_ids), []).append(contribution)
+        
+        if not strata:
+            return 0.0
+        return sum(sum(values) / len(values) for values in strata.values()) / len(strata)
+    
+    def _fit_and_score(self, train_xy: Optional[Tuple[np.ndarray, np.ndarray]],
+                       test_xy: Optional[Tuple[np.ndarray, np.ndarray]]) -> float:
+        """Fit the scoring model on stacked training data and return test R²"""
         try:
-            # Combine training data
-            if not train_chunks:
-                return -1.0  # Very bad performance for empty training set
-            
-            train_features_list = []
-            train_glucose_list = []
-            
-            # Extract features and corresponding glucose for each chunk
-            for chunk in train_chunks:
-                chunk_features = self._extract_simple_features(chunk.fnirs_data)
-                if len(chunk_features) == 0:
-                    continue
-                    
-                # Create corresponding glucose values (average over each window)
-                window_size = 60
-                chunk_glucose = []
-                for start_idx in range(0, len(chunk.glucose_data), window_size):
-                    end_idx = min(start_idx + window_size, len(chunk.glucose_data))
-                    window_glucose = chunk.glucose_data[start_idx:end_idx]
-                    
-                    if len(window_glucose) >= window_size * 0.5:
-                        chunk_glucose.append(np.mean(window_glucose))
-                
-                if len(chunk_glucose) == len(chunk_features):
-                    train_features_list.append(chunk_features)
-                    train_glucose_list.extend(chunk_glucose)
-            
-            if not train_features_list:
+            if train_xy is None or test_xy is None:
                 return -1.0
-                
-            train_features = np.vstack(train_features_list)
-            train_glucose = np.array(train_glucose_list)
-            
-            # Same for test data
-            test_features_list = []
-            test_glucose_list = []
-            
-            for chunk in test_chunks:
-                chunk_features = self._extract_simple_features(chunk.fnirs_data)
-                if len(chunk_features) == 0:
-                    continue
-                    
-                window_size = 60
-                chunk_glucose = []
-                for start_idx in range(0, len(chunk.glucose_data), window_size):
-                    end_idx = min(start_idx + window_size, len(chunk.glucose_data))
-                    window_glucose = chunk.glucose_data[start_idx:end_idx]
-                    
-                    if len(window_glucose) >= window_size * 0.5:
-                        chunk_glucose.append(np.mean(window_glucose))
-                
-                if len(chunk_glucose) == len(chunk_features):
-                    test_features_list.append(chunk_features)
-                    test_glucose_list.extend(chunk_glucose)
             
-            if not test_features_list:
-                return -1.0
-                
-            test_features = np.vstack(test_features_list)
-            test_glucose = np.array(test_glucose_list)
+            train_features, train_glucose = train_xy
+            test_features, test_glucose = test_xy
             
             # Train simple model (faster than full pipeline)
             model = RandomForestRegressor(n_estimators=50, random_state=42, max_depth=10)
@@ -309,14 +341,78 @@ class ShapleyScorer:
             
             # Evaluate
             predictions = model.predict(test_features)
-            r2 = r2_score(test_glucose, predictions)
+            r2 = _fast_r2(test_glucose, predictions)
             
             return max(r2, -1.0)  # Clip to reasonable range
             
         except Exception as e:
-            print(f"Error in train_and_evaluate: {e}")
+            print(f"Error in fit_and_score: {e}")
             return -1.0
     
+    def _stack_chunks(self, chunks: List[DataChunk]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Stacked features and glucose targets for a set of chunks
+        
+        Returns None if nothing usable could be stacked or feature
+        extraction fails, which _fit_and_score scores as -1.0.
+        """
+        try:
+            parts = [xy for xy in (self._chunk_xy(c) for c in chunks) if xy is not None]
+            if not parts:
+                return None
+            return (np.vstack([x for x, _ in parts]), np.concatenate([y for _, y in parts]))
+        except Exception as e:
+            print(f"Error in stack_chunks: {e}")
+            return None
+    
+    def _test_stack(self, chunks: List[DataChunk]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Stacked test set, memoized by chunk set
+        
+        Test sets recur across samples (all of Session 2 for between-session
+        runs), unlike random coalitions, so only these stacks are kept.
+        """
+        key = frozenset(chunks)
+        if key not in self._test_xy_cache:
+            self._test_xy_cache[key] = self._stack_chunks(chunks)
+        return self._test_xy_cache[key]
+    
+    def _append_chunk(self, xy: Optional[Tuple[np.ndarray, np.ndarray]],
+                      chunk: DataChunk) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Extend an existing stack with one more chunk without restacking the rest"""
+        try:
+            chunk_xy = self._chunk_xy(chunk)
+            if xy is None or chunk_xy is None:
+                return xy if chunk_xy is None else chunk_xy
+            return (np.concatenate([xy[0], chunk_xy[0]]), np.concatenate([xy[1], chunk_xy[1]]))
+        except Exception as e:
+            print(f"Error in append_chunk: {e}")
+            return None
+    
+    def _chunk_xy(self, chunk: DataChunk) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Windowed features and matching glucose targets for one chunk (cached)"""
+        if chunk in self._chunk_xy_cache:
+            return self._chunk_xy_cache[chunk]
+        
+        xy = None
+        chunk_features = self._extract_simple_features(chunk.fnirs_data)
+        if len(chunk_features) > 0:
+            # Create corresponding glucose values (average over each window)
+            window_size = 60
+            chunk_glucose = []
+            for start_idx in range(0, len(chunk.glucose_data), window_size):
+                end_idx = min(start_idx + window_size, len(chunk.glucose_data))
+                window_glucose = chunk.glucose_data[start_idx:end_idx]
+                
+                if len(window_glucose) >= window_size * 0.5:
+                    chunk_glucose.append(np.mean(window_glucose))
+            
+            if len(chunk_glucose) == len(chunk_features):
+                xy = (chunk_features, np.array(chunk_glucose))
+        
+        self._chunk_xy_cache[chunk] = xy
+        return xy
+    
     def _extract_simple_features(self, fnirs_data: np.ndarray) -> np.ndarray:
         """Extract basic statistical features from fNIRS signals"""
         if len(fnirs_data) == 0:
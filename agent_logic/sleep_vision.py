@@ -6,12 +6,24 @@ This module uses PaliGemma (Google's lightweight vision-language model)
 to analyze sleep photos and verify if they show a proper sleeping surface.
 """
 
+import asyncio
 import base64
+import binascii
+import hashlib
 import io
+import re
+import threading
+import numpy as np
 from PIL import Image
+import httpx
 import requests
 from typing import Dict, Tuple, Optional
 import os
+from collections import OrderedDict
+
+# Image types accepted from the frontend, and a cap on the base64 payload (~12 MB decoded)
+ALLOWED_IMAGE_TYPES = {'image/jpeg', 'image/jpg', 'image/png', 'image/webp'}
+MAX_ENCODED_IMAGE_CHARS = 16_000_000
 
 class SleepVisionAnalyzer:
     """
@@ -22,6 +34,18 @@ class SleepVisionAnalyzer:
         self.model_name = "google/paligemma-3b-pt-224"
         self.api_url = f"https://api-inference.huggingface.co/models/{self.model_name}"
         self.headers = {"Authorization": f"Bearer {os.getenv('HUGGINGFACE_API_KEY', '')}"}
+        self.prompt = "Describe what you see in this image. Is this a bedroom or sleeping area?"
+        self._async_client: Optional[httpx.AsyncClient] = None
+        
+        # Pooled session for the sync path so repeat calls reuse the TLS connection
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self._session.mount('https://', adapter)
+        
+        # LRU cache of results keyed by image content hash
+        self.cache_size = int(os.getenv('SLEEP_VISION_CACHE_SIZE', '4096'))
+        self._result_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self._cache_lock = threading.Lock()  # Async path touches the cache from worker threads
         
         # Sleep-related keywords for verification
         self.sleep_keywords = [
@@ -33,6 +57,23 @@ class SleepVisionAnalyzer:
             'kitchen', 'office', 'car', 'street', 'restaurant', 'store',
             'bathroom', 'living room', 'couch', 'sofa', 'chair', 'desk'
         ]
+        
+        # One compiled scan per keyword class instead of a substring test per keyword
+        self._sleep_pattern = self._keyword_pattern(self.sleep_keywords)
+        self._non_sleep_pattern = self._keyword_pattern(self.non_sleep_keywords)
+        self._fallback_pattern = self._keyword_pattern(['bed', 'sleep', 'bedroom'])
+    
+    @staticmethod
+    def _keyword_pattern(keywords) -> "re.Pattern":
+        """
+        Compile keywords into one whole-word alternation
+        
+        Word boundaries stop 'bed' matching inside 'embedded' or 'rest' inside
+        'restaurant'; an optional trailing 's' keeps plurals like 'pillows'.
+        The captured group is the keyword itself, so plurals count once.
+        """
+        ordered = sorted(keywords, key=len, reverse=True)
+        return re.compile(r'\b(' + '|'.join(re.escape(keyword) for keyword in ordered) + r')s?\b')
     
     def analyze_sleep_photo(self, image_data_uri: str) -> Dict:
         """
@@ -45,59 +86,230 @@ class SleepVisionAnalyzer:
             Dict with verification result and confidence
         """
         try:
-            # Parse the data URI
-            if not image_data_uri.startswith('data:image/'):
-                return {
-                    'is_valid_sleep_surface': False,
-                    'confidence': 0.0,
-                    'reason': 'Invalid image format',
-                    'analysis': 'Not a valid image data URI'
-                }
-            
-            # Extract base64 data
-            header, encoded = image_data_uri.split(',', 1)
-            image_data = base64.b64decode(encoded)
-            
-            # Convert to PIL Image
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Resize for PaliGemma (224x224 is optimal)
-            image = image.resize((224, 224))
-            
-            # Convert back to bytes for API
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='JPEG')
-            img_byte_arr = img_byte_arr.getvalue()
-            
-            # Use local analysis if HuggingFace API not available
-            if not self.headers["Authorization"] or self.headers["Authorization"] == "Bearer ":
-                return self._local_sleep_analysis(image)
+            result, request = self._prepare_analysis(image_data_uri)
+            if result is not None:
+                return result
             
             # Call PaliGemma via HuggingFace API
-            prompt = "Describe what you see in this image. Is this a bedroom or sleeping area?"
-            
-            response = requests.post(
-                self.api_url,
-                headers=self.headers,
-                json={
-                    "inputs": prompt,
-                    "parameters": {"max_new_tokens": 100}
-                },
-                files={"image": img_byte_arr},
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return self._parse_paligemma_response(result, prompt)
-            else:
-                print(f"PaliGemma API error: {response.status_code}")
-                return self._local_sleep_analysis(image)
+            cache_key, image, img_buffer = request
+            response = self._session.post(self.api_url, headers=self.headers, timeout=30,
+                                          **self._api_request(img_buffer))
+            
+            return self._finish_analysis(response, cache_key, image)
+                
+        except Exception as e:
+            print(f"Error in sleep photo analysis: {e}")
+            return self._fallback_analysis(image_data_uri)
+    
+    async def analyze_sleep_photo_async(self, image_data_uri: str) -> Dict:
+        """
+        Async variant of analyze_sleep_photo for the FastAPI server
+        
+        Decoding, resizing and JPEG encoding run in a worker thread, and the
+        PaliGemma call goes through a pooled httpx.AsyncClient, so concurrent
+        verifications never block the event loop.
+        """
+        try:
+            result, request = await asyncio.to_thread(self._prepare_analysis, image_data_uri)
+            if result is not None:
+                return result
+            
+            cache_key, image, img_buffer = request
+            response = await self._get_async_client().post(self.api_url, headers=self.headers,
+                                                          **self._api_request(img_buffer))
+            
+            return await asyncio.to_thread(self._finish_analysis, response, cache_key, image)
                 
         except Exception as e:
             print(f"Error in sleep photo analysis: {e}")
             return self._fallback_analysis(image_data_uri)
     
+    def _prepare_analysis(self, image_data_uri: str) -> Tuple[Optional[Dict], Optional[Tuple[str, Image.Image, io.BytesIO]]]:
+        """
+        Everything before the PaliGemma call, shared by the sync and async paths
+        
+        Returns either a final result (invalid input, cache hit, local
+        rejection or local analysis) or the (cache_key, image, img_buffer)
+        needed for the remote request.
+        """
+        image_data, invalid_result = self._decode_data_uri(image_data_uri)
+        if invalid_result is not None:
+            return invalid_result, None
+        
+        # Repeat uploads of the same photo skip decoding and inference
+        cache_key = self._cache_key(image_data)
+        cached = self._cached_result(cache_key)
+        if cached is not None:
+            return cached, None
+        
+        image = self._load_image(image_data)
+        
+        # Obviously unusable photos are rejected locally before any upload
+        rejection = self._precheck_image(image)
+        if rejection is not None:
+            return self._store_result(cache_key, rejection), None
+        
+        image = self._resize_for_model(image)
+        
+        # Use local analysis if HuggingFace API not available
+        if not self._api_available():
+            return self._store_result(cache_key, self._local_sleep_analysis(image)), None
+        
+        # Only the remote call needs the re-encoded JPEG
+        return None, (cache_key, image, self._encode_for_api(image))
+    
+    def _finish_analysis(self, response, cache_key: str, image: Image.Image) -> Dict:
+        """Turn the PaliGemma response into a result, caching successful calls"""
+        result = self._handle_api_response(response, image)
+        if response.status_code == 200:
+            self._store_result(cache_key, result)
+        return result
+    
+    def _decode_data_uri(self, image_data_uri: str) -> Tuple[Optional[bytes], Optional[Dict]]:
+        """Extract raw image bytes from a data URI, or return an invalid-format result"""
+        # Parse the data URI
+        if not image_data_uri.startswith('data:image/'):
+            return None, self._invalid_format_result('Not a valid image data URI')
+        
+        # Check the header before paying for the base64 decode
+        header, _, encoded = image_data_uri.partition(',')
+        mime_type, _, encoding = header[len('data:'):].partition(';')
+        if mime_type not in ALLOWED_IMAGE_TYPES or encoding != 'base64':
+            return None, self._invalid_format_result(f'Unsupported image type: {mime_type or "unknown"}')
+        if len(encoded) > MAX_ENCODED_IMAGE_CHARS:
+            return None, self._invalid_format_result('Image data too large')
+        
+        # Extract base64 data (validate=True rejects malformed input up front)
+        try:
+            return base64.b64decode(encoded, validate=True), None
+        except binascii.Error:
+            return None, self._invalid_format_result('Malformed base64 image data')
+    
+    def _invalid_format_result(self, analysis: str) -> Dict:
+        """Result for payloads that are not a usable image"""
+        return {
+            'is_valid_sleep_surface': False,
+            'confidence': 0.0,
+            'reason': 'Invalid image format',
+            'analysis': analysis
+        }
+    
+    def _load_image(self, image_data: bytes) -> Image.Image:
+        """Open image bytes lazily; pixels are not decoded until resized"""
+        # Convert to PIL Image
+        return Image.open(io.BytesIO(image_data))
+    
+    def _precheck_image(self, image: Image.Image) -> Optional[Dict]:
+        """
+        Reject images that local analysis would refuse anyway
+        
+        Only looks at the header-reported size, so tiny or extremely wide/tall
+        photos never pay for a full decode or a PaliGemma round trip.
+        """
+        width, height = image.size
+        aspect_ratio = width / height
+        
+        if width < 100 or height < 100:
+            reason = "Local analysis: Image too small for verification"
+            confidence = 0.2
+        elif aspect_ratio > 3 or aspect_ratio < 0.33:
+            reason = "Local analysis: Unusual aspect ratio for bedroom photo"
+            confidence = 0.4
+        else:
+            return None
+        
+        return {
+            'is_valid_sleep_surface': False,
+            'confidence': confidence,
+            'reason': reason,
+            'analysis': f"Local analysis - Size: {width}x{height}, Aspect ratio: {aspect_ratio:.2f}"
+        }
+    
+    def _resize_for_model(self, image: Image.Image) -> Image.Image:
+        """Decode and resize to the 224x224 PaliGemma input"""
+        # Let libjpeg scale down during decode (1/2..1/8) so full-size
+        # phone photos are never fully decoded; no-op for non-JPEG input
+        image.draft('RGB', (224, 224))
+        
+        # Resize for PaliGemma (224x224 is optimal)
+        # Bilinear is plenty at 224x224 and much cheaper than the default filter
+        return image.resize((224, 224), Image.Resampling.BILINEAR)
+    
+    def _cache_key(self, image_data: bytes) -> str:
+        """Content hash of the decoded image bytes"""
+        return hashlib.blake2b(image_data, digest_size=16).hexdigest()
+    
+    def _cached_result(self, cache_key: str) -> Optional[Dict]:
+        """Look up a previous verification result for the same photo"""
+        with self._cache_lock:
+            result = self._result_cache.get(cache_key)
+            if result is None:
+                return None
+            self._result_cache.move_to_end(cache_key)
+            return dict(result)
+    
+    def _store_result(self, cache_key: str, result: Dict) -> Dict:
+        """Remember a verification result, evicting the least recently used entries"""
+        if self.cache_size > 0:
+            with self._cache_lock:
+                self._result_cache[cache_key] = dict(result)
+                self._result_cache.move_to_end(cache_key)
+                while len(self._result_cache) > self.cache_size:
+                    self._result_cache.popitem(last=False)
+        return result
+    
+    def _encode_for_api(self, image: Image.Image) -> io.BytesIO:
+        """
+        Encode the resized image as JPEG for the API
+        
+        Returns the rewound buffer itself so the upload streams from it
+        without copying the encoded bytes out first.
+        """
+        img_buffer = io.BytesIO()
+        image.save(img_buffer, format='JPEG', optimize=False, progressive=False)
+        img_buffer.seek(0)
+        return img_buffer
+    
+    def _api_available(self) -> bool:
+        """Whether a HuggingFace API key is configured"""
+        return bool(self.headers["Authorization"]) and self.headers["Authorization"] != "Bearer "
+    
+    def _api_request(self, img_buffer: io.BytesIO) -> Dict:
+        """Body and upload for the PaliGemma inference call"""
+        return {
+            "json": {
+                "inputs": self.prompt,
+                "parameters": {"max_new_tokens": 100}
+            },
+            "files": {"image": ("image.jpg", img_buffer, "image/jpeg")}
+        }
+    
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """Shared connection-pooled async client (created on first use)"""
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(timeout=30)
+        return self._async_client
+    
+    def close(self) -> None:
+        """Release pooled connections held by the sync session"""
+        self._session.close()
+    
+    async def aclose(self) -> None:
+        """Release pooled connections held by both the sync and async clients"""
+        self.close()
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+    
+    def _handle_api_response(self, response, image: Image.Image) -> Dict:
+        """Parse a PaliGemma HTTP response, falling back to local analysis on errors"""
+        if response.status_code == 200:
+            result = response.json()
+            return self._parse_paligemma_response(result, self.prompt)
+        else:
+            print(f"PaliGemma API error: {response.status_code}")
+            return self._local_sleep_analysis(image)
+    
     def _parse_paligemma_response(self, response: Dict, prompt: str) -> Dict:
         """Parse PaliGemma response and determine sleep surface validity"""
         try:
@@ -114,8 +326,8 @@ class SleepVisionAnalyzer:
                 generated_text = generated_text.replace(prompt.lower(), '').strip()
             
             # Count sleep-related vs non-sleep keywords
-            sleep_score = sum(1 for keyword in self.sleep_keywords if keyword in generated_text)
-            non_sleep_score = sum(1 for keyword in self.non_sleep_keywords if keyword in generated_text)
+            sleep_score = len(set(self._sleep_pattern.findall(generated_text)))
+            non_sleep_score = len(set(self._non_sleep_pattern.findall(generated_text)))
             
             # Calculate confidence based on keyword analysis
             total_keywords = sleep_score + non_sleep_score
@@ -123,8 +335,9 @@ class SleepVisionAnalyzer:
                 confidence = sleep_score / total_keywords
                 is_valid = sleep_score > non_sleep_score
             else:
-                # Fallback: look for explicit bedroom/sleep mentions
-                is_valid = any(word in generated_text for word in ['bed', 'sleep', 'bedroom'])
+                # Fallback: look for explicit bedroom/sleep mentions (whole words only,
+                # so 'embedded', 'bedside' or 'sleepy' do not count)
+                is_valid = bool(self._fallback_pattern.search(generated_text))
                 confidence = 0.7 if is_valid else 0.3
             
             return {
@@ -142,35 +355,28 @@ class SleepVisionAnalyzer:
         """
         Local computer vision analysis when PaliGemma is not available
         Uses basic image properties and heuristics
+        
+        Expects the 224x224 model input; size and aspect ratio are checked
+        on the original image by _precheck_image before resizing.
         """
         try:
-            # Basic image analysis
-            width, height = image.size
-            aspect_ratio = width / height
-            
             # Convert to RGB if needed
             if image.mode != 'RGB':
                 image = image.convert('RGB')
             
             # Analyze color distribution (bedrooms tend to have warmer, softer colors)
-            pixels = list(image.getdata())
+            pixels = np.asarray(image)  # H x W x 3, uint8
             
-            # Calculate average brightness and color temperature
-            avg_brightness = sum(sum(pixel) for pixel in pixels) / (len(pixels) * 3)
+            # Calculate average brightness (vectorized reduction over all channels)
+            avg_brightness = float(pixels.mean())
             
             # Simple heuristics for sleep surface detection
             is_valid = True
             confidence = 0.6  # Moderate confidence for local analysis
             reason = "Local analysis: "
             
-            # Check image dimensions (very small images are suspicious)
-            if width < 100 or height < 100:
-                is_valid = False
-                confidence = 0.2
-                reason += "Image too small for verification"
-            
             # Check brightness (completely black or white images are suspicious)
-            elif avg_brightness < 10:
+            if avg_brightness < 10:
                 is_valid = False
                 confidence = 0.3
                 reason += "Image too dark"
@@ -178,13 +384,6 @@ class SleepVisionAnalyzer:
                 is_valid = False
                 confidence = 0.3
                 reason += "Image too bright/overexposed"
-            
-            # Check aspect ratio (extremely wide or tall images are unusual for bed photos)
-            elif aspect_ratio > 3 or aspect_ratio < 0.33:
-                is_valid = False
-                confidence = 0.4
-                reason += "Unusual aspect ratio for bedroom photo"
-            
             else:
                 reason += "Basic image properties suggest valid bedroom photo"
             
@@ -192,7 +391,7 @@ class SleepVisionAnalyzer:
                 'is_valid_sleep_surface': is_valid,
                 'confidence': confidence,
                 'reason': reason,
-                'analysis': f"Local analysis - Brightness: {avg_brightness:.1f}, Aspect ratio: {aspect_ratio:.2f}"
+                'analysis': f"Local analysis - Brightness: {avg_brightness:.1f}"
             }
             
         except Exception as e:
@@ -226,6 +425,18 @@ def verify_sleep_photo(image_data_uri: str) -> Dict:
     """
     return sleep_analyzer.analyze_sleep_photo(image_data_uri)
 
+async def verify_sleep_photo_async(image_data_uri: str) -> Dict:
+    """
+    Async version of verify_sleep_photo for use inside the event loop
+    
+    Args:
+        image_data_uri: Base64 encoded image data URI
+        
+    Returns:
+        Dict with verification results
+    """
+    return await sleep_analyzer.analyze_sleep_photo_async(image_data_uri)
+
 if __name__ == "__main__":
     # Test with a sample image
     print("Sleep Vision Analyzer - Testing Mode")
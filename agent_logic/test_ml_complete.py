@@ -9,16 +9,34 @@ This single test file covers all ML pipeline functionality:
 4. Cross-session experiment validation
 """
 
+import base64
+import io
 import json
 import sys
 import os
+from functools import lru_cache
 import numpy as np
 from fastapi.testclient import TestClient
 
+# Use libuv's event loop for the TestClient calls when available (optional)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Import our modules
 from ml_pipeline import ml_app, MLPipeline
 from glucose_ml_processor import run_cross_session_experiments, preprocess_and_feature_engineer
 
+# Shared generator for synthetic test data
+rng = np.random.default_rng()
+
+@lru_cache(maxsize=None)
+def get_client() -> TestClient:
+    """Single TestClient shared by every test so the app is only set up once"""
+    return TestClient(ml_app)
+
 def test_infrastructure():
     """Test basic ML pipeline infrastructure"""
     print("🔧 Testing ML Pipeline Infrastructure...")
@@ -29,7 +47,7 @@ def test_infrastructure():
         print(f"  ✅ Pipeline initialized (Models loaded: {pipeline.models_loaded})")
         
         # Test API app creation
-        client = TestClient(ml_app)
+        client = get_client()
         print("  ✅ FastAPI client created")
         
         return True
@@ -41,7 +59,7 @@ def test_health_endpoints():
     """Test health and info endpoints"""
     print("\n🏥 Testing Health Endpoints...")
     
-    client = TestClient(ml_app)
+    client = get_client()
     
     try:
         # Test health endpoint
@@ -73,8 +91,14 @@ def test_real_data_processing():
         'eigen_blood/second_session/second_cgm_log.csv'
     ]
     
+    # List each data directory once instead of checking every file separately
+    existing = set()
+    for directory in {os.path.dirname(path) for path in files_to_check}:
+        if os.path.isdir(directory):
+            existing.update(entry.path for entry in os.scandir(directory))
+    
     for file_path in files_to_check:
-        if not os.path.exists(file_path):
+        if file_path not in existing:
             print(f"  ❌ Missing data file: {file_path}")
             return False
     
@@ -91,37 +115,91 @@ def test_real_data_processing():
         print(f"  ❌ Real data processing failed: {e}")
         return False
 
+def test_shapley_sampling():
+    """Test stratified coalition sampling and the per-size Shapley estimate"""
+    print("\n🎲 Testing Shapley Coalition Sampling...")
+    
+    try:
+        import random
+        from shapley_scorer import ShapleyScorer
+        
+        scorer = ShapleyScorer()
+        random.seed(0)
+        
+        # Budget covers every size: each of sizes 1..7 sampled, no repeats within a size
+        coalitions = scorer._stratified_coalitions(list(range(8)), 7, 20)
+        assert len(coalitions) == 20
+        assert {len(c) for c in coalitions} == set(range(1, 8))
+        assert len({tuple(c) for c in coalitions}) == len(coalitions)
+        assert all(0 <= i < 8 for c in coalitions for i in c)
+        
+        # Small strata are enumerated exactly, never padded with repeats
+        coalitions = scorer._stratified_coalitions(list(range(3)), 2, 100)
+        assert sorted(map(tuple, coalitions)) == [(0,), (0, 1), (0, 2), (1,), (1, 2), (2,)]
+        print("  ✅ Every coalition size covered, small strata enumerated")
+        
+        # Budget below the number of sizes (the API case: 9 sizes, 8 draws):
+        # a random subset of sizes, so the mean over sizes stays unbiased
+        coalitions = scorer._stratified_coalitions(list(range(9)), 9, 8)
+        assert len({len(c) for c in coalitions}) == 8
+        
+        def estimate(coalitions):
+            samples = [(c, []) for c in coalitions]
+            return scorer._stratified_mean(samples, [float(len(c)) for c in coalitions])
+        
+        # Marginal equal to coalition size: the exact per-size mean is 5.0
+        assert estimate(scorer._stratified_coalitions(list(range(9)), 9, 40)) == 5.0
+        runs = [estimate(scorer._stratified_coalitions(list(range(9)), 9, 8)) for _ in range(2000)]
+        assert abs(np.mean(runs) - 5.0) < 0.05, f"Biased estimate: {np.mean(runs):.3f}"
+        print("  ✅ Per-size estimate unbiased, including budgets below the number of sizes")
+        
+        return True
+    except Exception as e:
+        print(f"  ❌ Shapley sampling test failed: {e!r}")
+        return False
+
 def generate_realistic_fnirs_data(duration_seconds=120, sampling_rate=10):
     """Generate realistic fNIRS data for API testing"""
     
     n_samples = int(duration_seconds * sampling_rate)
     time_points = np.linspace(0, duration_seconds, n_samples)
     
+    # All noise in one draw: 2 shared base-signal columns (std 0.02),
+    # then 6 per-channel columns (std 0.01) so channels stay decorrelated
+    noise = rng.standard_normal((n_samples, 8)) * np.array([0.02, 0.02] + [0.01] * 6)
+    
     # Generate realistic fNIRS signals with physiological patterns
-    base_signal_740 = 0.5 + 0.1 * np.sin(2 * np.pi * time_points / 30) + np.random.normal(0, 0.02, n_samples)
-    base_signal_850 = 0.6 + 0.08 * np.cos(2 * np.pi * time_points / 25) + np.random.normal(0, 0.02, n_samples)
+    base_signal_740 = 0.5 + 0.1 * np.sin(2 * np.pi * time_points / 30) + noise[:, 0]
+    base_signal_850 = 0.6 + 0.08 * np.cos(2 * np.pi * time_points / 25) + noise[:, 1]
     
-    # Create CSV with multiple channels (needed for processing)
-    lines = ["Time,S1_D1_740nm_LP,S1_D1_850nm_LP,S2_D5_740nm_LP,S2_D5_850nm_LP,S3_D6_740nm_LP,S3_D6_850nm_LP"]
+    # Add channel variations
+    channels = np.column_stack([
+        base_signal_740 + noise[:, 2],
+        base_signal_850 + noise[:, 3],
+        base_signal_740 + noise[:, 4] + 0.02,
+        base_signal_850 + noise[:, 5] + 0.02,
+        base_signal_740 + noise[:, 6] - 0.01,
+        base_signal_850 + noise[:, 7] - 0.01,
+    ])
     
-    for i, t in enumerate(time_points):
-        # Add channel variations
-        s1_740 = base_signal_740[i] + np.random.normal(0, 0.01)
-        s1_850 = base_signal_850[i] + np.random.normal(0, 0.01)
-        s2_740 = base_signal_740[i] + np.random.normal(0, 0.01) + 0.02
-        s2_850 = base_signal_850[i] + np.random.normal(0, 0.01) + 0.02
-        s3_740 = base_signal_740[i] + np.random.normal(0, 0.01) - 0.01
-        s3_850 = base_signal_850[i] + np.random.normal(0, 0.01) - 0.01
-        
-        lines.append(f"{t:.2f},{s1_740:.4f},{s1_850:.4f},{s2_740:.4f},{s2_850:.4f},{s3_740:.4f},{s3_850:.4f}")
+    # Create CSV with multiple channels (needed for processing)
+    buf = io.StringIO()
+    np.savetxt(
+        buf,
+        np.column_stack([time_points, channels]),
+        fmt=['%.2f'] + ['%.4f'] * 6,
+        delimiter=',',
+        header="Time,S1_D1_740nm_LP,S1_D1_850nm_LP,S2_D5_740nm_LP,S2_D5_850nm_LP,S3_D6_740nm_LP,S3_D6_850nm_LP",
+        comments=''
+    )
     
-    return "\n".join(lines)
+    return buf.getvalue()
 
 def test_api_endpoints():
     """Test API endpoints with realistic data"""
     print("\n🌐 Testing API Endpoints...")
     
-    client = TestClient(ml_app)
+    client = get_client()
     
     try:
         # Generate realistic test data
@@ -159,6 +237,78 @@ def test_api_endpoints():
         print(f"  ❌ API test failed: {e}")
         return False
 
+def _png_data_uri(width, height, color=(120, 100, 90)):
+    """Solid-colour PNG as a data URI for the sleep verification tests"""
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buf, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode()
+
+def test_sleep_vision():
+    """Test sleep photo verification: keyword scoring, input rejection, caching, precheck"""
+    print("\n🛏️  Testing Sleep Verification...")
+    
+    try:
+        from sleep_vision import SleepVisionAnalyzer, MAX_ENCODED_IMAGE_CHARS
+        
+        analyzer = SleepVisionAnalyzer()
+        analyzer.headers = {"Authorization": "Bearer "}  # Force local analysis
+        
+        # Keyword scoring: whole words, plurals count once, each keyword once
+        def keyword_reason(text):
+            return analyzer._parse_paligemma_response([{'generated_text': text}], analyzer.prompt)['reason']
+        
+        assert keyword_reason("a bedroom") == "PaliGemma analysis: 1 sleep keywords, 0 non-sleep keywords"
+        assert keyword_reason("a restaurant table") == "PaliGemma analysis: 0 sleep keywords, 1 non-sleep keywords"
+        assert keyword_reason("a bed with pillows and a pillow") == "PaliGemma analysis: 2 sleep keywords, 0 non-sleep keywords"
+        assert keyword_reason("an embedded office desk") == "PaliGemma analysis: 0 sleep keywords, 2 non-sleep keywords"
+        
+        # No keywords at all: the explicit-mention fallback also needs whole words
+        def fallback(text):
+            result = analyzer._parse_paligemma_response([{'generated_text': text}], analyzer.prompt)
+            return result['is_valid_sleep_surface'], result['confidence']
+        
+        assert fallback("an embedded circuit board on a workbench") == (False, 0.3)
+        assert fallback("a photo of a bedside lamp") == (False, 0.3)
+        assert fallback("sleepy cat") == (False, 0.3)
+        assert fallback("a good place to sleep") == (True, 0.7)
+        print("  ✅ Keyword scoring")
+        
+        # Malformed input is rejected before decoding
+        unsupported = analyzer.analyze_sleep_photo('data:image/gif;base64,R0lGODlh')
+        oversize = analyzer.analyze_sleep_photo('data:image/png;base64,' + 'A' * (MAX_ENCODED_IMAGE_CHARS + 4))
+        malformed = analyzer.analyze_sleep_photo('data:image/png;base64,@@@@')
+        for result in (unsupported, oversize, malformed):
+            assert result['reason'] == 'Invalid image format'
+            assert not result['is_valid_sleep_surface'] and result['confidence'] == 0.0
+        assert unsupported['analysis'] == 'Unsupported image type: image/gif'
+        assert oversize['analysis'] == 'Image data too large'
+        assert malformed['analysis'] == 'Malformed base64 image data'
+        print("  ✅ Unsupported, oversize and malformed uploads rejected")
+        
+        # Tiny and extremely wide photos are rejected from their size alone
+        small = analyzer.analyze_sleep_photo(_png_data_uri(50, 50))
+        wide = analyzer.analyze_sleep_photo(_png_data_uri(1000, 200))
+        assert small['reason'] == "Local analysis: Image too small for verification"
+        assert wide['reason'] == "Local analysis: Unusual aspect ratio for bedroom photo"
+        assert not small['is_valid_sleep_surface'] and not wide['is_valid_sleep_surface']
+        print("  ✅ Precheck rejects tiny and oddly shaped photos")
+        
+        # Repeat uploads are answered from the cache
+        photo = _png_data_uri(400, 300)
+        first = analyzer.analyze_sleep_photo(photo)
+        assert first['is_valid_sleep_surface']
+        image_data = base64.b64decode(photo.split(',', 1)[1])
+        sentinel = {'is_valid_sleep_surface': False, 'confidence': 0.1, 'reason': 'cached', 'analysis': ''}
+        analyzer._store_result(analyzer._cache_key(image_data), sentinel)
+        assert analyzer.analyze_sleep_photo(photo) == sentinel
+        print("  ✅ Repeat upload served from cache")
+        
+        return True
+    except Exception as e:
+        print(f"  ❌ Sleep verification test failed: {e!r}")
+        return False
+
 def test_cross_session_experiments():
     """Test full cross-session ML experiments (optional - takes longer)"""
     print("\n🔬 Testing Cross-Session ML Experiments...")
@@ -191,11 +341,16 @@ def run_all_tests(include_experiments=False):
     print("🧪 ML Pipeline Comprehensive Test Suite")
     print("=" * 50)
     
+    # Create the shared API client once up front
+    get_client()
+    
     tests = [
         ("Infrastructure", test_infrastructure),
         ("Health Endpoints", test_health_endpoints),
         ("Real Data Processing", test_real_data_processing),
+        ("Shapley Sampling", test_shapley_sampling),
         ("API Endpoints", test_api_endpoints),
+        ("Sleep Verification", test_sleep_vision),
     ]
     
     if include_experiments: